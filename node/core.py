@@ -1,8 +1,10 @@
 """Core algorithm implementations and utils."""
 
+import inspect
 import tensorflow as tf
+from functools import wraps
 
-from node.utils.nest import nest_map
+from node.solvers.checkpointed import CheckpointedSolver
 
 
 class Backward:
@@ -35,7 +37,82 @@ class Backward:
     return NotImplemented
 
 
-def reverse_mode_derivative(ode_solver, network, variables):
+class _AugmentedDynamics(tf.Module):
+  """The dynamics of the augmented phase point in the algorithm 1 of the
+  paper (1806.07366), which is the phase vector field of the `Backward`.
+
+  As a `tf.Module`, the `network` and the `variables` are tracked as its
+  attributes, instead of being captured by a closure. (`variables` is stored
+  as `watched_variables`, since `tf.Module.variables` is reserved.)
+
+  Parameters
+  ----------
+  network : PhaseVectorField
+  variables: list of tf.Variable
+  """
+
+  def __init__(self, network, variables):
+    super().__init__(name='augmented_dynamics')
+    self.network = network
+    self.watched_variables = variables
+
+    # The gradients by variables are packed into one flat tensor in the
+    # augmented phase point, so that the ODE solver updates them all at once,
+    # instead of one by one.
+    self.var_dtype = variables[0].dtype if variables else tf.float32
+    self.var_sizes = [
+      tf.TensorShape(var.shape).num_elements() for var in variables]
+
+    # The `__call__` has no control flow on tensors, so AutoGraph is turned
+    # off for it, leaving a straight-line graph for XLA to fuse. The `network`,
+    # which may have, is still converted by wrapping it in a `tf.function`.
+    self.network_fn = tf.function(network)
+
+  @tf.function(jit_compile=True, reduce_retracing=True, autograph=False)
+  def __call__(self, time, aug_phase_point):
+    state, adjoint, _ = aug_phase_point
+    neg_adjoint = tf.nest.map_structure(tf.negative, adjoint)
+
+    # The adjoint method is optimize-then-discretize: any tape enclosing the
+    # backward shall see the state as a constant, while the local tape still
+    # watches it.
+    state = tf.nest.map_structure(tf.stop_gradient, state)
+    # Watch only what the VJPs are computed for, instead of all the trainable
+    # variables accessed by the `network`.
+    with tf.GradientTape(watch_accessed_variables=False) as g:
+      g.watch(state)
+      g.watch(self.watched_variables)
+      output = self.network_fn(time, state)
+    # According to
+    # # https://www.tensorflow.org/api_docs/python/tf/custom_gradient
+    # `tf.gradients` or `g.gradient`, if the third argument is filled,
+    # returns the vector-Jacobian-products directly. In fact, TF
+    # implements VJP inside, and compute gradients via VJP.
+    #
+    # Forward-mode (`tf.autodiff.ForwardAccumulator`) is not used here: it
+    # gives the JVP, while the adjoint dynamics needs the VJP, which would
+    # cost one forward pass per component of the state. And the reverse pass
+    # is needed by the variables anyway, which gives the VJP by the state
+    # for free.
+    state_vjp, var_vjps = g.gradient(
+      output, [state, self.watched_variables], neg_adjoint)
+
+    # Whether a source is connected to the `output` is known at tracing time,
+    # where the unconnected get `None`. Instead of `ZerosLike` ops computed on
+    # each step (as `unconnected_gradients='zero'` does), the variables get
+    # zeros of static shape, which are constant-folded.
+    state_vjp = tf.nest.map_structure(
+      lambda vjp, x: tf.zeros_like(x) if vjp is None else vjp,
+      state_vjp, state)
+    var_vjps = [tf.zeros(var.shape, var.dtype) if vjp is None else vjp
+                for vjp, var in zip(var_vjps, self.watched_variables)]
+
+    new_aug_phase_point = [output, state_vjp,
+                           _flatten_grads(var_vjps, self.var_dtype)]
+    return new_aug_phase_point
+
+
+def reverse_mode_derivative(ode_solver, network, variables, signature=None):
   """Implements the algorithm 1 in the paper original paper (1806.07366).
 
   Parameters
@@ -46,51 +123,117 @@ def reverse_mode_derivative(ode_solver, network, variables):
   variables: list of tf.Variable
     The :math`\theta` in the paper. In practice, it's a list of variables.
     Thus :math`\theta = (\theta_1, \ldots)`,
+  signature : nest structure of tf.TensorSpec, optional
+    The signature of the phase point, as in `get_node_function`. If provided,
+    the returned `Backward` is traced only once for all compatible inputs.
 
   Returns
   -------
   Backward
   """
 
-  @tf.function
-  def aug_dynamics(time, aug_phase_point):
-    state, adjoint, *_ = aug_phase_point
-    neg_adjoint = _negate(adjoint)
-
-    with tf.GradientTape() as g:
-      g.watch(state)
-      output = network(time, state)
-    # According to
-    # # https://www.tensorflow.org/api_docs/python/tf/custom_gradient
-    # `tf.gradients` or `g.gradient`, if the third argument is filled,
-    # returns the vector-Jacobian-products directly. In fact, TF
-    # implements VJP inside, and compute gradients via VJP.
-    vjps = g.gradient(output, [state] + variables, neg_adjoint,
-                      unconnected_gradients='zero')
+  aug_dynamics = _AugmentedDynamics(network, variables)
+  forward = ode_solver(aug_dynamics)
 
-    new_aug_phase_point = [output] + vjps
-    return new_aug_phase_point
+  if signature:
+    dtype = get_dtype_from_signature(signature)
+    time_spec = tf.TensorSpec(shape=[], dtype=dtype)
+    input_signature = [time_spec, time_spec] + signature + signature
+  else:
+    input_signature = None
 
-  forward = ode_solver(aug_dynamics)
+  # The initial gradients by variables are always zeros. Create them once,
+  # out of any graph being traced, so that `backward` captures them as
+  # constants instead of creating them on each call.
+  with tf.init_scope():
+    var_zeros = tf.zeros([sum(aug_dynamics.var_sizes)],
+                         aug_dynamics.var_dtype)
 
-  @tf.function
+  @tf.function(input_signature=input_signature,
+               jit_compile=True, reduce_retracing=True)
   def backward(start_time, end_time, final_state, final_loss_gradient):
-    final_phase_point = [final_state, final_loss_gradient]
-    for var in variables:
-      zeros = tf.zeros_like(var)
-      final_phase_point.append(zeros)
+    final_phase_point = [final_state, final_loss_gradient, var_zeros]
     ode_result = forward(end_time,
                          start_time,
                          final_phase_point)
-    init_state, init_loss_gradient, *grad_loss_by_vars = ode_result.phase_point
-    return init_state, init_loss_gradient, list(grad_loss_by_vars)
+    init_state, init_loss_gradient, flat_grads = ode_result.phase_point
+    grad_loss_by_vars = _unflatten_grads(
+      flat_grads, variables, aug_dynamics.var_sizes)
+    return init_state, init_loss_gradient, grad_loss_by_vars
 
   return backward
 
 
-@nest_map
-def _negate(x):
-  return -1 * x
+def _flatten_grads(grads, dtype):
+  """Packs the gradients by variables into one flat tensor.
+
+  Parameters
+  ----------
+  grads : list of tensor
+  dtype : tf.Dtype
+    The dtype of the returned tensor when `grads` is empty.
+
+  Returns
+  -------
+  tensor
+    Shape `[N]`, where `N` is the total size of `grads`.
+  """
+  if not grads:
+    return tf.zeros([0], dtype)
+  return tf.concat([tf.reshape(grad, [-1]) for grad in grads], axis=0)
+
+
+def _unflatten_grads(flat_grads, variables, sizes):
+  """Inverse of `_flatten_grads`.
+
+  Parameters
+  ----------
+  flat_grads : tensor
+    Shape `[N]`, where `N` is the total size of `variables`.
+  variables : list of tf.Variable
+  sizes : list of int
+    The sizes of `variables`.
+
+  Returns
+  -------
+  list of tensor
+    The same shapes as `variables`.
+  """
+  if not variables:
+    return []
+  grads = tf.split(flat_grads, sizes)
+  return [tf.reshape(grad, var.shape) for grad, var in zip(grads, variables)]
+
+
+def _backward_getter(ode_solver, network, signature=None):
+  """Cached version of `reverse_mode_derivative`.
+
+  Building a new `Backward` for each call of `grad_fn` would re-trace it on
+  every backward pass. So, instead, the `Backward` is built once for each
+  list of variables, and is cached as long as the returned function lives,
+  instead of globally.
+
+  Parameters
+  ----------
+  ode_solver : ODESolver
+  network : PhaseVectorField
+  signature : nest structure of tf.TensorSpec, optional
+
+  Returns
+  -------
+  callable
+    Maps the variables (list of tf.Variable) to the `Backward`.
+  """
+  cache = {}
+
+  def get_backward(variables):
+    key = tuple(var.ref() for var in variables)
+    if key not in cache:
+      cache[key] = reverse_mode_derivative(
+        ode_solver, network, variables, signature)
+    return cache[key]
+
+  return get_backward
 
 
 def get_dtype_from_signature(signature):
@@ -103,13 +246,69 @@ def get_dtype_from_signature(signature):
   -------
   tf.Dtype
   """
-  spec = signature[0]
-  while not isinstance(spec, tf.TensorSpec):
-    spec = spec[0]
-  dtype = spec.dtype
-  return dtype
+  return tf.nest.flatten(signature)[0].dtype
+
+
+def _get_pack(signature):
+  """Returns the function that nests back a flat phase point.
+
+  If the `signature` is provided, the nest structure is fixed in advance,
+  instead of being read from a phase point of the same structure.
+
+  Parameters
+  ----------
+  signature : nest structure of tf.TensorSpec, optional
+
+  Returns
+  -------
+  callable
+    Arguments are the flat phase point and a phase point of the same
+    structure, and returns the nested phase point.
+  """
+  if not signature:
+    return lambda flat, like: tf.nest.pack_sequence_as(like, flat)
+  structure = signature[0]
+  return lambda flat, like: tf.nest.pack_sequence_as(structure, flat)
+
 
+def _to_hashable(arg):
+  """Converts the lists and dicts in a (nest) argument to tuples."""
+  if isinstance(arg, (list, tuple)):
+    return tuple(_to_hashable(_) for _ in arg)
+  if isinstance(arg, dict):
+    return tuple((k, _to_hashable(v)) for k, v in sorted(arg.items()))
+  return arg
 
+
+def _memoize(factory):
+  """Decorator that caches the functions returned by `factory`, so that
+  calling `factory` with the same arguments repeatedly (e.g. per batch)
+  neither rebuilds nor re-traces the returned `tf.function`.
+
+  The arguments are keyed by identity, except for the nest structures of
+  `tf.TensorSpec`, which are keyed by value. Unhashable arguments disable the
+  cache.
+  """
+  cache = {}
+  factory_signature = inspect.signature(factory)
+
+  @wraps(factory)
+  def memoized_factory(*args, **kwargs):
+    bound_args = factory_signature.bind(*args, **kwargs)
+    bound_args.apply_defaults()
+    key = _to_hashable(list(bound_args.arguments.values()))
+    try:
+      hash(key)
+    except TypeError:
+      return factory(*args, **kwargs)
+    if key not in cache:
+      cache[key] = factory(*args, **kwargs)
+    return cache[key]
+
+  return memoized_factory
+
+
+@_memoize
 def get_node_function(solver, fn, signature=None):
   r"""
 
@@ -136,7 +335,7 @@ def get_node_function(solver, fn, signature=None):
   -------
   PhaseVectorField
   """
-  forward = solver(fn)
+  solve = solver(fn)
 
   if signature:
     dtype = get_dtype_from_signature(signature)
@@ -145,6 +344,23 @@ def get_node_function(solver, fn, signature=None):
     input_signature = [t0_spec, t1_spec] + signature
   else:
     input_signature = None
+  pack = _get_pack(signature)
+
+  if isinstance(solver, CheckpointedSolver):
+    # Differentiated by gradient checkpointing instead of the adjoint method.
+    @tf.function(input_signature=input_signature)
+    def checkpointed_node_fn(t0, t1, x0):
+      return solve(t0, t1, x0).phase_point
+
+    return checkpointed_node_fn
+
+  # XLA cannot compile across the boundary of `tf.custom_gradient`, so we
+  # compile the ODE solving within it instead of the `node_fn`.
+  @tf.function(jit_compile=True, reduce_retracing=True)
+  def forward(t0, t1, x0):
+    return solve(t0, t1, x0)
+
+  get_backward = _backward_getter(solver, fn, signature)
 
   @tf.function(input_signature=input_signature)
   def node_fn(t0, t1, x0):
@@ -174,7 +390,7 @@ def get_node_function(solver, fn, signature=None):
       function, and nest back within this function.
       """
       # nest back the flatten phase point to the original
-      x = tf.nest.pack_sequence_as(x0, list(x))
+      x = pack(list(x), x0)
 
       ode_result = forward(t0, t1, x)
       y = ode_result.phase_point
@@ -183,7 +399,7 @@ def get_node_function(solver, fn, signature=None):
       # and pass them into the `grad_fn` via the `variables` kwarg.
       @tf.function
       def grad_fn(*grad_ys, **kwargs):
-        grad_ys = tf.nest.pack_sequence_as(y, list(grad_ys))
+        grad_ys = pack(list(grad_ys), y)
 
         # XXX: `tf.custom_gradient` has an unfixed
         # [bug](https://github.com/tensorflow/tensorflow/issues/31945).
@@ -192,9 +408,9 @@ def get_node_function(solver, fn, signature=None):
         # TODO: Re-write this part when the bug is fixed.
         variables = kwargs.get('variables', None)
 
-        backward = reverse_mode_derivative(solver, fn, variables)
+        backward = get_backward(variables)
         _, grad_by_x, grad_by_vars = backward(t0, t1, y, grad_ys)
-        return [grad_by_x], grad_by_vars
+        return tf.nest.flatten(grad_by_x), grad_by_vars
 
       return y, grad_fn
 
@@ -203,6 +419,46 @@ def get_node_function(solver, fn, signature=None):
   return node_fn
 
 
+@_memoize
+def get_batched_node_function(solver, fn, signature=None, batch_axis=0):
+  """Like `get_node_function`, but the `fn` is the phase vector field of a
+  single sample, while the returned node function accepts a batch of samples.
+
+  The whole batch is solved as one ODE, with `fn` vectorized along the batch
+  axis, instead of calling the node function once per sample. Since the
+  samples are independent, the gradients by variables are summed over the
+  batch.
+
+  Parameters
+  ----------
+  solver : ODESolver
+  fn : PhaseVectorField
+    The phase vector field of a single sample, without batch axis.
+  signature : nest structure of tf.TensorSpec, optional
+    The signature of the batched phase point.
+  batch_axis : int, optional
+    The batch axis of (each tensor in) the batched phase point.
+
+  Returns
+  -------
+  PhaseVectorField
+  """
+
+  def move_axis(x, source, destination):
+    if source == destination:
+      return x
+    return tf.nest.map_structure(
+      lambda _: tf.experimental.numpy.moveaxis(_, source, destination), x)
+
+  def batched_fn(t, x):
+    x = move_axis(x, batch_axis, 0)
+    y = tf.vectorized_map(lambda x_i: fn(t, x_i), x)
+    return move_axis(y, 0, batch_axis)
+
+  return get_node_function(solver, batched_fn, signature)
+
+
+@_memoize
 def get_dynamical_node_function(
   dynamical_solver, static_solver, fn, stop_condition, signature=None):
   """Generalization of the `get_node_function` for dynamical solver.
@@ -220,7 +476,11 @@ def get_dynamical_node_function(
   -------
   PhaseVectorField
   """
+  # Unlike `get_node_function`, the forward is not compiled by XLA, since
+  # the stop condition, which can be stateful (e.g. `StopCondition`), is
+  # called in the condition of the while-loop, which XLA does not support.
   forward = dynamical_solver(fn, stop_condition)
+  get_backward = _backward_getter(static_solver, fn, signature)
 
   if signature:
     dtype = get_dtype_from_signature(signature)
@@ -228,6 +488,7 @@ def get_dynamical_node_function(
     input_signature = [t0_spec] + signature
   else:
     input_signature = None
+  pack = _get_pack(signature)
 
   @tf.function(input_signature=input_signature)
   def node_fn(t0, x0):
@@ -256,7 +517,7 @@ def get_dynamical_node_function(
       function, and nest back within this function.
       """
       # nest back the flatten phase point to the original
-      x = tf.nest.pack_sequence_as(x0, list(x))
+      x = pack(list(x), x0)
 
       ode_result = forward(t0, x)
       t1 = ode_result.time
@@ -266,7 +527,7 @@ def get_dynamical_node_function(
       # and pass them into the `grad_fn` via the `variables` kwarg.
       @tf.function
       def grad_fn(*grad_ys, **kwargs):
-        grad_ys = tf.nest.pack_sequence_as(y, list(grad_ys))
+        grad_ys = pack(list(grad_ys), y)
 
         # XXX: `tf.custom_gradient` has an unfixed
         # [bug](https://github.com/tensorflow/tensorflow/issues/31945).
@@ -275,9 +536,9 @@ def get_dynamical_node_function(
         # TODO: Re-write this part when the bug is fixed.
         variables = kwargs.get('variables', None)
 
-        backward = reverse_mode_derivative(static_solver, fn, variables)
+        backward = get_backward(variables)
         _, grad_by_x, grad_by_vars = backward(t0, t1, y, grad_ys)
-        return [grad_by_x], grad_by_vars
+        return tf.nest.flatten(grad_by_x), grad_by_vars
 
       return y, grad_fn
 
@@ -311,12 +572,23 @@ class StopCondition:
 
     self.relax_time = tf.Variable(0., trainable=False)
 
-  @tf.function
+  @tf.function(jit_compile=True)
   def __call__(self, t0, x0, t1, x1):
-    if t1 - t0 > self.max_time:
-      self.relax_time.assign(-1)
-      return True
-    if tf.reduce_max(tf.abs(self.pvf(t1, x1))) < self.relax_tol:
-      self.relax_time.assign(t1)
-      return True
-    return False
+    # Explicit `tf.cond`s make sure that `self.pvf` is evaluated only when
+    # `self.max_time` has not been reached.
+    return tf.cond(t1 - t0 > self.max_time,
+                   self._on_max_time,
+                   lambda: self._check_relax(t1, x1))
+
+  def _on_max_time(self):
+    self.relax_time.assign(-1.)
+    return tf.constant(True)
+
+  def _check_relax(self, t, x):
+    r = tf.reduce_max(tf.abs(self.pvf(t, x)))
+
+    def on_relax():
+      self.relax_time.assign(t)
+      return tf.constant(True)
+
+    return tf.cond(r < self.relax_tol, on_relax, lambda: tf.constant(False))
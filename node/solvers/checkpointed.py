@@ -0,0 +1,103 @@
+import tensorflow as tf
+from collections import namedtuple
+from node.base import ODEResult, ODESolver
+
+
+CheckpointedDiagnostics = namedtuple(
+  'CheckpointedDiagnostics', 'num_checkpoints')
+
+
+class CheckpointedSolver(ODESolver):
+  r"""Wraps an ODE solver so that its forward is differentiable by gradient
+  checkpointing, instead of by the adjoint method.
+
+  ```math
+
+  The interval $[t_0, t_1]$ is split into $K$ uniform segments, and only the
+  phase points at the starts of the segments are stored in the forward. In the
+  backward, for each segment from the last to the first, the forward within
+  the segment is recomputed under a `tf.GradientTape`, and the gradients are
+  propagated through it by reverse-mode auto-differentiation.
+
+  ```
+
+  The gradients are thus the exact gradients of the discretized solution (i.e.
+  discretize-then-optimize), with the memory of one segment instead of the
+  whole interval, at the cost of one more forward in the backward. When
+  `num_checkpoints` is `None`, $K = \lceil \sqrt{N} \rceil$, where $N$ is the
+  (initial) number of steps of the base solver, so that the memory scales as
+  $O(\sqrt{N})$.
+
+  The `get_node_function` differentiates this solver directly, instead of via
+  the adjoint method.
+
+  Parameters
+  ----------
+  solver : ODESolver
+    The base solver, which shall have the attribute `dt` or `init_dt`, if
+    `num_checkpoints` is `None`.
+  num_checkpoints : int, optional
+  """
+
+  def __init__(self, solver, num_checkpoints=None):
+    self.solver = solver
+    self.num_checkpoints = num_checkpoints
+
+  def _get_num_segments(self, t0, t1):
+    if self.num_checkpoints is not None:
+      return tf.constant(self.num_checkpoints)
+    dt = getattr(self.solver, 'dt', None)
+    if dt is None:
+      dt = self.solver.init_dt
+    num_steps = tf.math.ceil(tf.abs(t1 - t0) / tf.cast(dt, t0.dtype))
+    num_segments = tf.math.ceil(tf.sqrt(num_steps))
+    return tf.maximum(tf.cast(num_segments, tf.int32), 1)
+
+  def __call__(self, fn):
+    solve = self.solver(fn)
+
+    @tf.function
+    def forward(t0, t1, x0):
+      num_segments = self._get_num_segments(t0, t1)
+      ts = tf.linspace(t0, t1, num_segments + 1)
+
+      def solve_segment(i, flat_x):
+        x = tf.nest.pack_sequence_as(x0, flat_x)
+        y = solve(ts[i], ts[i + 1], x).phase_point
+        return tf.nest.flatten(y)
+
+      @tf.custom_gradient
+      def custom_gradient_fn(*flat_x):
+        flat_x = list(flat_x)
+        checkpoints = [
+          tf.TensorArray(_.dtype, size=num_segments, element_shape=_.shape)
+          for _ in flat_x]
+        for i in tf.range(num_segments):
+          checkpoints = [ta.write(i, _) for ta, _ in zip(checkpoints, flat_x)]
+          flat_x = solve_segment(i, flat_x)
+        checkpoints = [ta.stack() for ta in checkpoints]
+
+        @tf.function
+        def grad_fn(*grad_ys, **kwargs):
+          # C.f. the `grad_fn` in `node.core.get_node_function`.
+          variables = kwargs.get('variables', None) or []
+
+          grad_by_x = list(grad_ys)
+          grad_by_vars = [tf.zeros_like(var) for var in variables]
+          for i in tf.range(num_segments - 1, -1, -1):
+            xi = [ckpt[i] for ckpt in checkpoints]
+            with tf.GradientTape() as g:
+              g.watch(xi)
+              yi = solve_segment(i, xi)
+            grad_by_x, grads = g.gradient(
+              yi, [xi, variables], grad_by_x, unconnected_gradients='zero')
+            grad_by_vars = [a + b for a, b in zip(grad_by_vars, grads)]
+          return grad_by_x, grad_by_vars
+
+        return flat_x, grad_fn
+
+      flat_x1 = custom_gradient_fn(*tf.nest.flatten(x0))
+      x1 = tf.nest.pack_sequence_as(x0, flat_x1)
+      return ODEResult(t1, x1, CheckpointedDiagnostics(num_segments))
+
+    return forward
@@ -2,8 +2,8 @@ import tensorflow as tf
 from node.base import DynamicalODESolver, ODEResult
 from node.utils.nest import nest_map
 from node.solvers.runge_kutta import (
-  add, norm, sign, RungeKuttaStep, RungeKuttaDiagnostics,
-  RungeKuttaFehlbergDiagnostics)
+  add, cache_forward, linear_combination, norm, sign, RungeKuttaStep,
+  RungeKuttaDiagnostics, RungeKuttaFehlbergDiagnostics)
 
 
 class DynamicalRungeKuttaSolver(DynamicalODESolver):
@@ -38,11 +38,12 @@ class DynamicalRungeKuttaSolver(DynamicalODESolver):
     self.min_dt = tf.convert_to_tensor(min_dt, dtype=dtype)
     self._rk_step = RungeKuttaStep(a, b)
 
+  @cache_forward
   def __call__(self, fn, stop_condition):
 
     @nest_map
     def dx(*ks):
-      return sum(ci * ki for ci, ki in zip(self.c, ks))
+      return linear_combination(self.c, ks)
 
     @tf.function
     def forward(t0, x0, reverse=False):
@@ -113,17 +114,18 @@ class DynamicalRungeKuttaFehlbergSolver(DynamicalODESolver):
       self.max_dt = tf.convert_to_tensor(max_dt, dtype=dtype)
     self._rk_step = RungeKuttaStep(a, b)
 
+  @cache_forward
   def __call__(self, fn, stop_condition):
 
     @nest_map
     def dx(*ks):
-      return sum(ci * ki for ci, ki in zip(self.c, ks))
+      return linear_combination(self.c, ks)
 
     def error(dt, *ks):
 
       @nest_map
       def _rs(*ks):
-        return sum(ei * ki for ei, ki in zip(self.e, ks)) / dt
+        return linear_combination(self.e, ks) / dt
 
       return norm(_rs(*ks))
 
@@ -1,5 +1,6 @@
 import tensorflow as tf
 from collections import namedtuple
+from functools import wraps
 from node.base import ODEResult, ODESolver
 from node.utils.nest import nest_map
 
@@ -42,6 +43,51 @@ def scalar_product(scalar, phase_point):
   return _scalar_product(phase_point)
 
 
+def linear_combination(coefficients, tensors):
+  r"""Computes :math:`\sum_i c_i x_i` by one `AddN` op, instead of a chain of
+  `Add` ops, skipping the vanishing coefficients. Unit coefficients need no
+  `Mul` op, and minus unit coefficients need only a `Neg` op.
+
+  Parameters
+  ----------
+  coefficients : list of float
+    At least one shall be non-zero.
+  tensors : list of tensor
+
+  Returns
+  -------
+  tensor
+  """
+
+  def scale(c, x):
+    if c == 1:
+      return x
+    if c == -1:
+      return tf.negative(x)
+    return c * x
+
+  return tf.add_n([scale(c, x)
+                   for c, x in zip(coefficients, tensors) if c != 0])
+
+
+def cache_forward(call):
+  """Decorator for the `__call__` of ODE solvers, so that calling a solver
+  with the same arguments (e.g. the same phase vector field) again returns
+  the same `forward`, instead of a new `tf.function` to be traced again.
+
+  The cache lives as long as the solver.
+  """
+
+  @wraps(call)
+  def cached_call(self, *args):
+    cache = self.__dict__.setdefault('_forward_cache', {})
+    if args not in cache:
+      cache[args] = call(self, *args)
+    return cache[args]
+
+  return cached_call
+
+
 @tf.function
 def sign(x):
   r"""Like `tf.sign`, but keeps the dtype.
@@ -119,7 +165,7 @@ class RungeKuttaStep:
 
         @nest_map
         def xi(x, *ks):
-          return x + sum(bij * kj for bij, kj in zip(self.b[i], ks))
+          return linear_combination([1] + self.b[i], [x] + list(ks))
 
         ki = scalar_product(dt, fn(ti, xi(x, *ks)))
         ks.append(ki)
@@ -160,11 +206,12 @@ class RungeKuttaSolver(ODESolver):
     self.min_dt = tf.convert_to_tensor(min_dt, dtype=dtype)
     self._rk_step = RungeKuttaStep(a, b)
 
+  @cache_forward
   def __call__(self, fn):
 
     @nest_map
     def dx(*ks):
-      return sum(ci * ki for ci, ki in zip(self.c, ks))
+      return linear_combination(self.c, ks)
 
     @tf.function
     def forward(t0, t1, x0):
@@ -262,17 +309,18 @@ class RungeKuttaFehlbergSolver(ODESolver):
       self.max_dt = tf.convert_to_tensor(max_dt, dtype=dtype)
     self._rk_step = RungeKuttaStep(a, b)
 
+  @cache_forward
   def __call__(self, fn):
 
     @nest_map
     def dx(*ks):
-      return sum(ci * ki for ci, ki in zip(self.c, ks))
+      return linear_combination(self.c, ks)
 
     def error(dt, *ks):
 
       @nest_map
       def _rs(*ks):
-        return sum(ei * ki for ei, ki in zip(self.e, ks)) / dt
+        return linear_combination(self.e, ks) / dt
 
       return norm(_rs(*ks))
 
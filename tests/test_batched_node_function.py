@@ -0,0 +1,52 @@
+import tensorflow as tf
+from node.core import get_batched_node_function, get_node_function
+from node.solvers.runge_kutta import RK4Solver
+
+
+solver = RK4Solver(0.1)
+dense = tf.keras.layers.Dense(3)
+dense.build([None, 3])
+
+
+def f(t, x):
+  """Phase vector field of a single sample, i.e. `x` has shape `[3]`."""
+  return tf.squeeze(dense(x[tf.newaxis, :]), axis=0)
+
+
+t0 = tf.constant(0.)
+t1 = tf.constant(1.)
+
+
+def test_batched_node_function(batch_axis):
+  samples = [tf.random.uniform(shape=[3]) for _ in range(4)]
+  x0 = tf.stack(samples, axis=batch_axis)
+
+  batched_node_f = get_batched_node_function(
+    solver, f, batch_axis=batch_axis)
+  with tf.GradientTape() as g:
+    g.watch(x0)
+    x1 = batched_node_f(t0, t1, x0)
+  grads = g.gradient(x1, [x0] + dense.trainable_variables)
+
+  node_f = get_node_function(solver, f)
+  expected_x1 = []
+  expected_grads = [tf.zeros_like(var) for var in dense.trainable_variables]
+  for sample in samples:
+    with tf.GradientTape() as g:
+      g.watch(sample)
+      y = node_f(t0, t1, sample)
+    expected_x1.append(y)
+    var_grads = g.gradient(y, dense.trainable_variables)
+    expected_grads = [a + b for a, b in zip(expected_grads, var_grads)]
+  expected_x1 = tf.stack(expected_x1, axis=batch_axis)
+
+  tf.debugging.assert_near(x1, expected_x1, atol=1e-4)
+  for grad, expected_grad in zip(grads[1:], expected_grads):
+    tf.debugging.assert_near(grad, expected_grad, atol=1e-3)
+  assert grads[0].shape == x0.shape
+  print('Succeed in testing batched node function on batch axis {}.'
+        .format(batch_axis))
+
+
+test_batched_node_function(batch_axis=0)
+test_batched_node_function(batch_axis=1)
@@ -0,0 +1,45 @@
+import tensorflow as tf
+from node.core import get_node_function
+from node.solvers.checkpointed import CheckpointedSolver
+from node.solvers.runge_kutta import RK4Solver
+
+
+solver = RK4Solver(0.1)
+dense = tf.keras.layers.Dense(3, activation='tanh')
+dense.build([None, 3])
+
+
+def f(t, x):
+  return dense(x)
+
+
+t0 = tf.constant(0.)
+t1 = tf.constant(1.)
+x0 = tf.random.uniform(shape=[4, 3])
+
+
+def get_gradients(node_f):
+  with tf.GradientTape() as g:
+    g.watch(x0)
+    x1 = node_f(t0, t1, x0)
+    loss = tf.reduce_sum(x1 ** 2)
+  return g.gradient(loss, [x0] + dense.trainable_variables)
+
+
+def test_checkpointed_solver(num_checkpoints):
+  # Reverse-mode auto-differentiation through the whole solving.
+  forward = solver(f)
+  expected_grads = get_gradients(
+    lambda t0, t1, x0: forward(t0, t1, x0).phase_point)
+
+  checkpointed_solver = CheckpointedSolver(solver, num_checkpoints)
+  grads = get_gradients(get_node_function(checkpointed_solver, f))
+
+  for grad, expected_grad in zip(grads, expected_grads):
+    tf.debugging.assert_near(grad, expected_grad, atol=1e-4)
+  print('Succeed in testing checkpointed solver with {} checkpoints.'
+        .format(num_checkpoints))
+
+
+test_checkpointed_solver(num_checkpoints=None)
+test_checkpointed_solver(num_checkpoints=5)